@@ -1,11 +1,22 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import csv
 import pandas as pd
 import pandera as pa
+import pyarrow
+from pyarrow import csv as pa_csv
 import os
-from sqlalchemy import create_engine, Table, MetaData
+import psycopg
+from sqlalchemy import create_engine, Table, MetaData, Column, select, text
+from sqlalchemy.exc import DataError, IntegrityError, OperationalError
 from sqlalchemy.dialects.postgresql import insert
 from datetime import datetime
+from contextlib import closing
+from functools import lru_cache
+from graphlib import CycleError, TopologicalSorter
 import logging, time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 
 logging.basicConfig(
@@ -13,8 +24,23 @@ logging.basicConfig(
 )
 LOGGER = logging.getLogger(__name__)
 
-
-import time
+# Bytes of CSV parsed per chunk, roughly 50,000 rows of the source files
+CSV_BLOCK_SIZE = 8 * 1024 * 1024
+# Nullable dtypes keep integer columns integer when a value is missing
+NUMERIC_DTYPES = {
+    "int64": pd.Int64Dtype(),
+    "float64": pd.Float64Dtype(),
+}
+# Database errors caused by the values of a row, which splitting a batch can isolate.
+# COPY runs on the psycopg cursor, so its errors are not wrapped by SQLAlchemy.
+ROW_ERRORS = (IntegrityError, DataError, psycopg.IntegrityError, psycopg.DataError)
+# Splitting stops when nothing could be merged, once the rows are split in at
+# least UPSERT_MIN_FAILED_BATCHES batches of at most UPSERT_MIN_SPLIT_ROWS rows
+UPSERT_MIN_SPLIT_ROWS = 256
+UPSERT_MIN_FAILED_BATCHES = 16
+# Duplicate keys are resolved by the upsert, so they do not invalidate rows
+UNIQUENESS_CHECKS = {"field_uniqueness", "multiple_fields_uniqueness"}
+METADATA = MetaData()
 
 def main():
     """
@@ -37,48 +63,90 @@ def main():
     )
     table_schemas = get_table_schemas()
 
-    time.sleep(3)
     engine = get_db_engine(database_name, username, password, hostname, port)
-    error_handler.errors_table = Table(
-        "errors", MetaData(), schema=database_schema, autoload_with=engine
-    )
-
-    for table_name, table_schema in table_schemas.items():
-        if table_name == "products":
-            df = read_csv("source-data/inventory.csv", error_handler)
-        else:
-            df = read_csv(f"source-data/{table_name}.csv", error_handler)
+    wait_for_db(engine)
+    table_names = ["errors"]
+    for table_name in table_schemas:
+        table_names += [f"raw_{table_name}", table_name]
+    tables = reflect_tables(engine, database_schema, table_names)
+    primary_keys = get_primary_keys(tables)
+    error_handler.errors_table = tables["errors"]
+
+    # Tables are processed in parallel, but a table only upserts its rows once
+    # the tables it references are saved
+    table_dependencies = get_table_dependencies(tables, list(table_schemas))
+    futures = {}
+    with ThreadPoolExecutor(max_workers=len(table_schemas)) as executor:
+        for table_name in sort_tables(table_dependencies):
+            futures[table_name] = executor.submit(
+                process_table,
+                table_name,
+                table_schemas[table_name],
+                engine,
+                tables,
+                primary_keys,
+                error_handler,
+                [futures[name] for name in table_dependencies[table_name]],
+            )
+    for future in futures.values():
+        future.result()
+
+    with engine.begin() as conn:
+        error_handler.save_errors(conn)
 
-        if len(df) == 0:
-            error_handler.add_error(uuid4(), table_name, "No data found in CSV file.")
-            continue
+    duration = time.time() - start
+    LOGGER.info(f"Script execution complete in {duration} seconds.")
 
-        raw_table = Table(
-            f"raw_{table_name}", MetaData(), schema=database_schema, autoload_with=engine
-        )
-        table = Table(
-            table_name, MetaData(), schema=database_schema, autoload_with=engine
-        )
 
-        df.columns = [col.lower() for col in df.columns]
+def process_table(
+    table_name,
+    table_schema,
+    engine,
+    tables,
+    primary_keys,
+    error_handler,
+    dependencies=(),
+):
+    """Read, validate and save the CSV file of a table in a single transaction
 
-        validate_schema(df, table_schema, error_handler)
+    Args:
+        table_name (str): Name of the table
+        table_schema (pandera.DataFrameSchema): Table schema object
+        engine (Engine): Database engine object
+        tables (dict): Dictionary mapping table names to Table objects
+        primary_keys (dict): Dictionary mapping table names to primary keys
+        error_handler (errorHandler): Error handler object
+        dependencies (list): Futures of the tables referenced by this table
+    """
+    if table_name == "products":
+        file_path = "source-data/inventory.csv"
+    else:
+        file_path = f"source-data/{table_name}.csv"
+    # Parse the next chunks while the current one is written to the database
+    chunks = prefetch(read_csv(file_path, error_handler))
 
-        df = df.where(pd.notnull(df), None)
+    raw_table = tables[f"raw_{table_name}"]
+    table = tables[table_name]
+    row_count = 0
 
-        for row in df.itertuples(index=False):
-            with engine.connect() as conn:
-                save_to_raw_data_table(row, raw_table, conn, error_handler)
+    # Closing the chunks stops the reader thread if a chunk fails to save
+    with closing(chunks), engine.begin() as conn:
+        for df in chunks:
+            row_count += len(df)
 
-            with engine.connect() as conn:
-                if validate_row_data(row, table, table_schema, error_handler):
-                    upsert_row(row, table, conn, error_handler)
+            df, raw_df = convert_numeric_columns(df, table_schema, error_handler)
+            valid_df = validate_schema(df, table_schema, error_handler)
 
-    with engine.connect() as conn:
-        error_handler.save_errors(conn)
+            save_to_raw_data_table(raw_df, raw_table, conn, error_handler)
+            # Referenced rows must be committed before the foreign keys are checked
+            for dependency in dependencies:
+                dependency.result()
+            upsert_rows(
+                valid_df, table, primary_keys[table_name], conn, error_handler
+            )
 
-    duration = time.time() - start
-    LOGGER.info(f"Script execution complete in {duration} seconds.")
+    if row_count == 0:
+        error_handler.add_error(uuid4(), table_name, "No data found in CSV file.")
 
 
 def get_env_variables():
@@ -152,23 +220,111 @@ def get_table_schemas():
     return table_schemas
 
 def read_csv(file_path, error_handler):
-    """Read CSV file and return DataFrame
+    """Read CSV file with pyarrow in chunks of CSV_BLOCK_SIZE bytes
+
+    Column names are lowercased to match the table schemas. Every column is
+    read as strings, since Arrow infers types from the first chunk only and
+    would fail on a later chunk with a decimal or malformed number. Rows with
+    the wrong number of fields are reported to the error handler and skipped.
 
     Args:
         file_path (str): Path to CSV file
         error_handler (errorHandler): Error handler object
 
-    Returns:
-        pd.DataFrame: DataFrame containing data from CSV file
+    Yields:
+        pd.DataFrame: DataFrame containing a chunk of the CSV file
     """
     LOGGER.info(f"Reading CSV file: {file_path}")
+
+    def skip_invalid_row(row):
+        error_handler.add_error(
+            uuid4(),
+            file_path,
+            f"Skipped invalid row {row.number} in CSV file: {file_path}. "
+            f"Expected {row.expected_columns} fields, got {row.actual_columns}: {row.text}",
+        )
+        return "skip"
+
     try:
-        return pd.read_csv(file_path, index_col=False)
+        with open(file_path, newline="") as f:
+            header = next(csv.reader(f), [])
+        # Lowercase the column names while parsing instead of renaming each chunk
+        column_names = [col.lower() for col in header]
+        read_options = pa_csv.ReadOptions(
+            column_names=column_names,
+            skip_rows=1,
+            block_size=CSV_BLOCK_SIZE,
+        )
+        convert_options = pa_csv.ConvertOptions(
+            column_types={col: pyarrow.string() for col in column_names},
+            strings_can_be_null=True,
+        )
+        parse_options = pa_csv.ParseOptions(invalid_row_handler=skip_invalid_row)
+        # Closing the generator early also closes the reader and its file
+        with pa_csv.open_csv(
+            file_path,
+            read_options=read_options,
+            parse_options=parse_options,
+            convert_options=convert_options,
+        ) as reader:
+            for batch in reader:
+                yield batch.to_pandas()
     except Exception as e:
         error_handler.add_error(
             uuid4(), file_path, f"Error reading CSV file: {file_path}. Error: {e}"
         )
-        return pd.DataFrame()
+
+
+def prefetch(iterable, depth=2, timeout=0.1):
+    """Consume an iterable in a background thread, keeping items ready ahead
+
+    When the consumer stops iterating, the background thread stops and closes
+    the iterable, so that a generator can release its resources.
+
+    Args:
+        iterable (iterable): Iterable to consume
+        depth (int): Maximum number of items buffered ahead of the consumer
+        timeout (float): Seconds between checks that the consumer still iterates
+
+    Yields:
+        object: Items of the iterable, in order
+    """
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=timeout)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
 
 
 def get_db_engine(db_name, user, password, hostname, port):
@@ -188,149 +344,428 @@ def get_db_engine(db_name, user, password, hostname, port):
         f"Creating database engine for {db_name}, host: {hostname}, port: {port}"
     )
     return create_engine(
-        f"postgresql://{user}:{password}@{hostname}:{port}/{db_name}"
+        f"postgresql+psycopg://{user}:{password}@{hostname}:{port}/{db_name}",
+        pool_size=4,
+        max_overflow=4,
+        pool_pre_ping=True,
+        use_insertmanyvalues=True,
+        insertmanyvalues_page_size=1000,
     )
 
 
+def wait_for_db(engine, attempts=50, delay=0.2):
+    """Wait until the database accepts connections
+
+    Args:
+        engine (Engine): Database engine object
+        attempts (int): Maximum number of connection attempts
+        delay (float): Seconds to wait between attempts
+
+    Raises:
+        OperationalError: If the database is not available after all attempts
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            engine.connect().close()
+            return
+        except OperationalError as e:
+            if attempt == attempts:
+                LOGGER.error(f"Database not available after {attempts} attempts.")
+                raise e
+            time.sleep(delay)
+
+
+def reflect_tables(engine, schema, table_names):
+    """Reflect tables from the database, reusing tables reflected before
+
+    Args:
+        engine (Engine): Database engine object
+        schema (str): Database schema name
+        table_names (list): Names of the tables to reflect
+
+    Returns:
+        dict: Dictionary mapping table names to Table objects
+    """
+    missing = [
+        name for name in table_names if f"{schema}.{name}" not in METADATA.tables
+    ]
+    if missing:
+        LOGGER.info(f"Reflecting tables: {missing}")
+        METADATA.reflect(bind=engine, schema=schema, only=missing)
+    return {name: METADATA.tables[f"{schema}.{name}"] for name in table_names}
+
+
+def get_primary_keys(tables):
+    """Get the primary key column name of each table that has one
+
+    Args:
+        tables (dict): Dictionary mapping table names to Table objects
+
+    Returns:
+        dict: Dictionary mapping table names to primary key column names
+    """
+    return {
+        name: next(iter(table.primary_key.columns)).name
+        for name, table in tables.items()
+        if len(table.primary_key.columns)
+    }
+
+
+def get_table_dependencies(tables, table_names):
+    """Get the tables that each table references through its foreign keys
+
+    Args:
+        tables (dict): Dictionary mapping table names to Table objects
+        table_names (list): Names of the tables to get dependencies for
+
+    Returns:
+        dict: Dictionary mapping table names to the names of referenced tables
+    """
+    return {
+        name: sorted(
+            {
+                fk.column.table.name
+                for fk in tables[name].foreign_keys
+                if fk.column.table.name in table_names
+                and fk.column.table.name != name
+            }
+        )
+        for name in table_names
+    }
+
+
+def convert_numeric_columns(df, schema, error_handler):
+    """Convert the numeric columns of a DataFrame read as strings
+
+    Values that are not numbers, or not whole numbers in an integer column,
+    are reported to the error handler and their rows are left out of the
+    converted DataFrame.
+
+    Args:
+        df (pd.DataFrame): DataFrame with every column read as strings
+        schema (panderas.DataFrameSchema): Schema with the column dtypes
+        error_handler (errorHandler): Error handler object
+
+    Returns:
+        pd.DataFrame: DataFrame containing only the rows that were converted
+        pd.DataFrame: DataFrame containing every row, with the invalid values
+            kept as read
+    """
+    converted = df.copy()
+    invalid = {}
+    for col_name, col_object in schema.columns.items():
+        dtype = NUMERIC_DTYPES.get(str(col_object.dtype))
+        if dtype is None or col_name not in df.columns:
+            continue
+        values = pd.to_numeric(df[col_name], errors="coerce")
+        failed = values.isna() & df[col_name].notna()
+        if dtype == pd.Int64Dtype():
+            failed |= values.notna() & (values % 1 != 0)
+        converted[col_name] = values.where(~failed).astype(dtype)
+        if failed.any():
+            invalid[col_name] = failed
+    if not invalid:
+        return converted, converted
+
+    invalid = pd.DataFrame(invalid)
+    invalid_rows = invalid.index[invalid.any(axis=1)]
+    for index in invalid_rows:
+        error_fields = [
+            (col, df.at[index, col]) for col in invalid if invalid.at[index, col]
+        ]
+        error_handler.add_error(
+            uuid4(),
+            schema.name,
+            f"Invalid fields for columns in row {df.at[index, df.columns[0]]}: {error_fields}",
+        )
+    raw_df = converted.astype(object)
+    for col in invalid:
+        raw_df[col] = raw_df[col].mask(invalid[col], df[col])
+    return converted.drop(index=invalid_rows), raw_df
+
+
+def sort_tables(table_dependencies):
+    """Sort tables so that every table comes after the tables it references
+
+    Args:
+        table_dependencies (dict): Dictionary mapping table names to the names
+            of referenced tables
+
+    Returns:
+        list: Table names in dependency order
+
+    Raises:
+        ValueError: If the tables reference each other in a cycle
+    """
+    try:
+        return list(TopologicalSorter(table_dependencies).static_order())
+    except CycleError as e:
+        raise ValueError(f"Tables reference each other in a cycle: {e.args[1]}") from e
+
+
 def validate_schema(df, schema, error_handler):
     """Validate schema of DataFrame against schema object using pandera
 
+    Rows with invalid fields are reported to the error handler and left out
+    of the returned DataFrame. A failure that is not tied to a row, such as a
+    column with the wrong dtype, invalidates every row.
+
     Args:
         df (pd.DataFrame): DataFrame to validate
         schema (panderas.DataFrameSchema): Schema to validate against
         error_handler (errorHandler): Error handler object
+
+    Returns:
+        pd.DataFrame: DataFrame containing only the valid rows
     """
     LOGGER.info(f"Validating schema for {schema.name}")
     try:
-        schema.validate(df, lazy=True, inplace=True)
+        return schema.validate(df, lazy=True, inplace=True)
 
     except pa.errors.SchemaErrors as e:
         error_handler.add_error(
             uuid4(), schema.name, f"Error validating schema for {schema.name}: {e}"
         )
-
-
-def save_to_raw_data_table(row, table, conn, error_handler):
-    """Save data to raw table in database
+        failure_cases = e.failure_cases[
+            ~e.failure_cases["check"].isin(UNIQUENESS_CHECKS)
+        ]
+        if failure_cases.empty:
+            return df
+        if failure_cases["index"].isna().any():
+            return df.iloc[0:0]
+
+        for index, cases in failure_cases.groupby("index"):
+            error_fields = list(zip(cases["column"], cases["failure_case"]))
+            error_handler.add_error(
+                uuid4(),
+                schema.name,
+                f"Invalid fields for columns in row {df.at[index, df.columns[0]]}: {error_fields}",
+            )
+        return df.drop(index=failure_cases["index"].unique())
+
+
+def save_to_raw_data_table(df, table, conn, error_handler):
+    """Save data to raw table in database using COPY
 
     Args:
-        row (pd.Tuple): Row data
+        df (pd.DataFrame): DataFrame containing rows to save
         table (Table): Table object
         conn (Connection): Database connection object
         error_handler (errorHandler): Error handler object
-    '"""
+    """
+    # Every row of the batch is stamped with the time it was saved
+    timestamp = datetime.now().isoformat()
     try:
-        conn.begin()
-        payload = row._asdict()
-        timestamp = str(datetime.now())
-        result = conn.execute(
-            insert(table).values(payload=payload, timestamp=timestamp)
-        )
-        conn.commit()
-        if not result:
-            raise Exception("No rows inserted into raw table.")
+        table_name = conn.dialect.identifier_preparer.format_table(table)
+        with conn.begin_nested():
+            cursor = conn.connection.cursor()
+            with cursor.copy(
+                f"COPY {table_name} (payload, timestamp) FROM STDIN"
+            ) as copy:
+                # to_json serialises NaN as null, which json.dumps would not
+                for payload in df.to_json(orient="records", lines=True).splitlines():
+                    copy.write_row((payload, timestamp))
     except Exception as e:
         error_handler.add_error(
             uuid4(),
             table.name,
-            f"Error saving data to raw table raw_{table.name}. Error: {e}",
+            f"Error saving data to raw table {table.name}. Error: {e}",
         )
 
 
-def validate_row_data(row, table, table_schema, error_handler):
-    """Validate row data and send errors to error handler.
+@lru_cache(maxsize=None)
+def build_upsert_statements(table, primary_key, columns, dialect):
+    """Build the statements to upsert rows into table through a staging table
+
+    The result is cached, so the statements are built once per table instead
+    of once per chunk.
 
     Args:
-        row (pd.Tuple): Row data
         table (Table): Table object
-        table_schema (pandera.DataFrameSchema): Table schema object
-        error_handler (errorHandler): Error handler object
+        primary_key (str): Name of the primary key column
+        columns (tuple): Names of the columns to upsert
+        dialect (Dialect): Database dialect used to quote identifiers
 
     Returns:
-        bool: True if row data is valid, False otherwise
+        TextClause: Statement creating the staging table
+        str: COPY statement loading the staging table
+        Insert: Statement merging the staging table into the table
+        TextClause: Statement emptying the staging table
+        TextClause: Statement dropping the staging table
     """
-    optional_columns = set(
-        col_name
-        for col_name, col_object in table_schema.columns.items()
-        if col_object.nullable
+    staging = Table(
+        f"tmp_{table.name}", MetaData(), *[Column(col) for col in columns]
     )
-    error_fields = []
-    for col_name, col_value in row._asdict().items():
-        col_value = getattr(row, col_name)
-        schema_column_type = table_schema.dtypes[col_name].type
-
-        # Check if column is null but is optional or if column type is correct
-        if (pd.isnull(col_value) and col_name in optional_columns) or schema_column_type.__eq__(type(col_value)):
-            continue
-        error_fields.append((col_name, col_value))
+    preparer = dialect.identifier_preparer
+    staging_name = preparer.format_table(staging)
+    column_names = ", ".join(preparer.quote(col) for col in columns)
+
+    create_stmt = text(
+        f"CREATE TEMP TABLE {staging_name} "
+        f"(LIKE {preparer.format_table(table)} INCLUDING DEFAULTS) "
+        "ON COMMIT DROP"
+    )
+    copy_sql = f"COPY {staging_name} ({column_names}) FROM STDIN"
+    upsert_stmt = insert(table).from_select(
+        columns, select(*[staging.c[col] for col in columns])
+    )
+    upsert_stmt = upsert_stmt.on_conflict_do_update(
+        index_elements=[primary_key],
+        set_={
+            col: upsert_stmt.excluded[col] for col in columns if col != primary_key
+        },
+    )
+    truncate_stmt = text(f"TRUNCATE {staging_name}")
+    drop_stmt = text(f"DROP TABLE {staging_name}")
+    return create_stmt, copy_sql, upsert_stmt, truncate_stmt, drop_stmt
 
-    if error_fields:
-        error_handler.add_error(
-            uuid4(),
-            table.name,
-            f"Invalid fields for columns in row {row[0]}: {error_fields}",
-        )
-        return False
-    return True
 
+def upsert_rows(df, table, primary_key, conn, error_handler):
+    """Upsert rows into table through a temporary staging table
 
-def upsert_row(row, table, conn, error_handler):
-    """Upsert row data into table
+    The rows are loaded into a temporary table with COPY and then merged into
+    the target table with a single INSERT ... SELECT statement. When the merge
+    fails because of the values of a row, the rows are split in halves and
+    retried, so that the valid rows are still saved and each invalid row is
+    reported by its primary key. When every batch fails, the splitting stops
+    early and the rows are reported together, so that a chunk of invalid rows
+    does not cost a savepoint per row.
 
     Args:
-        row (pd.Series): Row data
+        df (pd.DataFrame): DataFrame containing rows to upsert
         table (Table): Table object
+        primary_key (str): Name of the primary key column
         conn (Connection): Database connection object
         error_handler (errorHandler): Error handler object
+
+    Raises:
+        Exception: If the rows could not be merged for another reason than
+            their values, such as a lost connection
     """
-    try:
-        primary_key = table.primary_key.columns.values()[0].name
-        row_data = row._asdict()
-        update_fields = row_data.copy()
-        del update_fields[primary_key]
-        stmt = (
-            insert(table)
-            .values(row_data)
-            .on_conflict_do_update(index_elements=[primary_key], set_=update_fields)
-        )
-        conn.begin()
-        result = conn.execute(stmt)
+    if df.empty:
+        return
+
+    # Keep only the last row per primary key, matching row-by-row upsert semantics
+    df = df.drop_duplicates(subset=[primary_key], keep="last")
+    columns = list(df.columns)
+    create_stmt, copy_sql, upsert_stmt, truncate_stmt, drop_stmt = (
+        build_upsert_statements(table, primary_key, tuple(columns), conn.dialect)
+    )
+    # psycopg cannot adapt the numpy scalars and pd.NA of nullable dtypes
+    rows = df.astype(object)
+    na_columns = [col for col in columns if df[col].hasnans]
+    if na_columns:
+        rows[na_columns] = rows[na_columns].where(df[na_columns].notna(), None)
+    rows = list(rows.itertuples(index=False, name=None))
+    keys = list(df[primary_key])
+
+    conn.execute(create_stmt)
+    # Batches are retried level by level, so that a level where every batch
+    # failed can be told apart from a few invalid rows
+    batches = [(0, len(rows))]
+    merged = False
+    while batches:
+        failed = []
+        for start, end in batches:
+            try:
+                merge_rows(rows[start:end], copy_sql, upsert_stmt, truncate_stmt, conn)
+                merged = True
+            except ROW_ERRORS as e:
+                failed.append((start, end, e))
+            except Exception as e:
+                error_handler.add_error(
+                    uuid4(), table.name, f"Error upserting rows into {table.name}: {e}."
+                )
+                raise e
+
+        batches = []
+        if not failed:
+            break
+        batch_size = failed[0][1] - failed[0][0]
+        if (
+            not merged
+            and batch_size <= UPSERT_MIN_SPLIT_ROWS
+            and len(failed) >= UPSERT_MIN_FAILED_BATCHES
+        ):
+            failed_keys = [keys[i] for start, end, _ in failed for i in range(start, end)]
+            error_handler.add_error(
+                uuid4(),
+                table.name,
+                f"Error upserting rows {failed_keys} into {table.name}, every batch failed: {failed[0][2]}.",
+            )
+            break
+        if batch_size == len(rows):
+            LOGGER.warning(
+                f"Upserting rows into {table.name} failed, retrying in smaller batches: {failed[0][2]}"
+            )
+        for start, end, e in failed:
+            if end - start == 1:
+                error_handler.add_error(
+                    uuid4(),
+                    table.name,
+                    f"Error upserting row {keys[start]} into {table.name}: {e}.",
+                )
+            else:
+                middle = (start + end) // 2
+                batches += [(start, middle), (middle, end)]
+    # Drop it now so the next chunk can create it again
+    conn.execute(drop_stmt)
+
+
+def merge_rows(rows, copy_sql, upsert_stmt, truncate_stmt, conn):
+    """Stage rows with COPY and merge them into the target table in a savepoint
+
+    The staging table is emptied after the merge, so it is empty before every
+    attempt, whether the previous one was merged or rolled back.
+
+    Args:
+        rows (list): Tuples of values to stage, in the staging table column order
+        copy_sql (str): COPY statement loading the staging table
+        upsert_stmt (Insert): Statement merging the staging table into the table
+        truncate_stmt (TextClause): Statement emptying the staging table
+        conn (Connection): Database connection object
+
+    Raises:
+        Exception: If the rows could not be merged, after rolling them back
+    """
+    with conn.begin_nested():
+        cursor = conn.connection.cursor()
+        with cursor.copy(copy_sql) as copy:
+            for row in rows:
+                copy.write_row(row)
+        result = conn.execute(upsert_stmt)
         if result is None or result.rowcount == 0:
-            raise Exception("Could not insert row.")
-        conn.commit()
-    except Exception as e:
-        error_handler.add_error(uuid4(), table.name, f"Error inserting row {row[0]}: {e}.")
+            raise Exception("Could not insert rows.")
+        conn.execute(truncate_stmt)
 
 
 class errorHandler:
     def __init__(self):
         self.errors = []
         self.errors_table = None
+        self._lock = threading.Lock()
 
     @dataclass
     class errorRecord:
         recordid: str
         recordtype: str
         errors: str
-        timestamp: datetime = str(datetime.now())
+        timestamp: datetime = field(default_factory=datetime.now)
 
     def _log_error(self, recordid, recordtype, error):
         LOGGER.error(f"Record: {recordtype} - id: {recordid} - error: {error}")
 
     def add_error(self, recordid, recordtype, error):
         self._log_error(recordid, recordtype, error)
-        self.errors.append(self.errorRecord(recordid, recordtype, error))
+        with self._lock:
+            self.errors.append(self.errorRecord(recordid, recordtype, error))
 
     def save_errors(self, conn):
         LOGGER.info("Saving errors to database")
         if self.errors:
-            conn.begin()
-            for e in self.errors:
-                conn.execute(
-                    insert(self.errors_table).values(e.__dict__)
-                )
-            conn.commit()
-            conn.close()
+            conn.execute(
+                insert(self.errors_table), [e.__dict__ for e in self.errors]
+            )
 
 if __name__ == "__main__":
     main()
@@ -1,18 +1,33 @@
+import json
+import os
+import tempfile
+import threading
 import unittest
-from unittest.mock import patch, mock_open, MagicMock
+from datetime import datetime
+from unittest.mock import patch, MagicMock
 from uuid import uuid4
 import pandas as pd
-from sqlalchemy.engine import Engine
-from sqlalchemy import Table, MetaData, Column, Integer, String, Float
+from sqlalchemy.engine import Engine, Connection
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy import Table, MetaData, Column, Integer, String, Float, JSON, ForeignKey
 from main import (
     read_csv,
+    prefetch,
     get_env_variables,
     get_table_schemas,
     get_db_engine,
+    wait_for_db,
+    reflect_tables,
+    get_primary_keys,
+    get_table_dependencies,
+    sort_tables,
+    process_table,
+    convert_numeric_columns,
     validate_schema,
     save_to_raw_data_table,
-    validate_row_data,
-    upsert_row,
+    build_upsert_statements,
+    upsert_rows,
     errorHandler,
 )
 
@@ -31,19 +46,128 @@ class TestMain(unittest.TestCase):
             "POSTGRES_PORT": "5432",
         }
 
-    @patch(
-        "builtins.open",
-        new_callable=mock_open,
-        read_data="productid,name,quantity,category,subcategory\n1,Product 1,10,Category A,Subcategory 1\n2,Product 2,20,Category B,Subcategory 2\n",
-    )
-    def test_read_csv(self, mock_open):
+    def test_read_csv(self):
         # Test reading CSV file
-        df = read_csv("test.csv", errorHandler())
-        mock_open.assert_called_with(
-            "test.csv", "r", encoding="utf-8", errors="strict", newline=""
-        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "test.csv")
+            with open(file_path, "w") as f:
+                f.write(
+                    "productId,name,quantity,category,subCategory\n"
+                    "0123,Product 1,10,Category A,\n"
+                    "0124,Product 2,,Category B,Subcategory 2\n"
+                )
+            chunks = list(read_csv(file_path, errorHandler()))
+        self.assertEqual(len(chunks), 1)
+        df = chunks[0]
         self.assertIsInstance(df, pd.DataFrame)
         self.assertEqual(len(df), 2)
+        # Columns are read as strings, keeping leading zeros, and empty values become null
+        self.assertEqual(
+            list(df.columns),
+            ["productid", "name", "quantity", "category", "subcategory"],
+        )
+        self.assertEqual(list(df["productid"]), ["0123", "0124"])
+        self.assertIsNone(df["subcategory"][0])
+        self.assertEqual(list(df["quantity"]), ["10", None])
+
+    @patch("main.CSV_BLOCK_SIZE", 64)
+    def test_read_csv_chunks(self):
+        # Test that large files are read in several chunks, and that values
+        # which do not match the first chunk's types do not stop the reader
+        values = [str(i) for i in range(60)]
+        values[31] = "abc"
+        values[45] = "4.99"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "test.csv")
+            with open(file_path, "w") as f:
+                f.write("productId,quantity\n")
+                f.writelines(f"prod{i},{value}\n" for i, value in enumerate(values))
+            error_handler = errorHandler()
+            chunks = list(read_csv(file_path, error_handler))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(list(pd.concat(chunks)["quantity"]), values)
+        self.assertFalse(error_handler.errors)
+
+    @patch("main.CSV_BLOCK_SIZE", 64)
+    def test_read_csv_invalid_rows(self):
+        # Test that rows with the wrong number of fields are reported and skipped
+        lines = [f"prod{i},{i}\n" for i in range(40)]
+        lines[25] = "prod25,25,extra\n"
+        lines[30] = "prod30\n"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "test.csv")
+            with open(file_path, "w") as f:
+                f.write("productId,quantity\n")
+                f.writelines(lines)
+            error_handler = errorHandler()
+            chunks = list(read_csv(file_path, error_handler))
+        productids = list(pd.concat(chunks)["productid"])
+        self.assertEqual(len(productids), 38)
+        self.assertNotIn("prod25", productids)
+        self.assertEqual(productids[-1], "prod39")
+        self.assertEqual(len(error_handler.errors), 2)
+        self.assertIn("prod25,25,extra", error_handler.errors[0].errors)
+
+    def test_read_csv_missing_file(self):
+        # Test that a missing file is reported and yields no chunks
+        error_handler = errorHandler()
+        self.assertEqual(list(read_csv("missing.csv", error_handler)), [])
+        self.assertEqual(len(error_handler.errors), 1)
+
+    def test_convert_numeric_columns(self):
+        # Test that only rows with malformed numbers are dropped, and that the
+        # raw rows keep the values as read
+        schema = get_table_schemas()["orders"]
+        df = pd.DataFrame(
+            {
+                "orderid": ["o1", "o2", "o3", "o4"],
+                "quantity": ["1", "abc", "4.99", None],
+                "amount": ["4.99", "2", "x", "3"],
+                "datetime": ["2024-01-01T00:00:00Z"] * 4,
+            }
+        )
+        error_handler = errorHandler()
+        converted, raw_df = convert_numeric_columns(df, schema, error_handler)
+        self.assertEqual(list(converted["orderid"]), ["o1", "o4"])
+        self.assertEqual(converted["quantity"].dtype, "Int64")
+        self.assertEqual(converted["amount"].dtype, "Float64")
+        self.assertEqual(converted.at[0, "amount"], 4.99)
+        self.assertTrue(pd.isna(converted.at[3, "quantity"]))
+        self.assertEqual(converted.at[0, "datetime"], "2024-01-01T00:00:00Z")
+        self.assertEqual(len(error_handler.errors), 2)
+        self.assertIn("row o2", error_handler.errors[0].errors)
+        self.assertIn("('amount', 'x')", error_handler.errors[1].errors)
+        self.assertEqual(list(raw_df["quantity"][:3]), [1, "abc", "4.99"])
+        self.assertEqual(len(raw_df), 4)
+
+    def test_prefetch(self):
+        # Test that prefetched items keep their order and errors are raised
+        self.assertEqual(list(prefetch(iter(range(10)))), list(range(10)))
+
+        def failing():
+            yield 1
+            raise ValueError("boom")
+
+        chunks = prefetch(failing())
+        self.assertEqual(next(chunks), 1)
+        with self.assertRaises(ValueError):
+            next(chunks)
+
+    def test_prefetch_stops(self):
+        # Test that the iterable is closed when the consumer stops iterating
+        closed = threading.Event()
+
+        def endless():
+            try:
+                while True:
+                    yield 1
+            finally:
+                closed.set()
+
+        chunks = prefetch(endless(), timeout=0.01)
+        self.assertEqual(next(chunks), 1)
+        chunks.close()
+        self.assertTrue(closed.wait(timeout=1))
 
     @patch.dict(
         "os.environ",
@@ -86,6 +210,117 @@ class TestMain(unittest.TestCase):
         mock_create_engine.return_value = mock_engine
         engine = get_db_engine(*list(self.env.values())[-5:])
         self.assertIsInstance(engine, Engine)
+        self.assertEqual(engine.pool.size(), 4)
+        self.assertEqual(engine.dialect.insertmanyvalues_page_size, 1000)
+
+    @patch("main.time.sleep")
+    def test_wait_for_db(self, mock_sleep):
+        # Test waiting for the database to accept connections
+        engine = MagicMock(spec=Engine)
+        error = OperationalError("SELECT 1", {}, Exception("not ready"))
+        engine.connect.side_effect = [error, error, MagicMock()]
+        wait_for_db(engine)
+        self.assertEqual(engine.connect.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+        engine.connect.side_effect = error
+        with self.assertRaises(OperationalError):
+            wait_for_db(engine, attempts=2)
+
+    @patch("main.METADATA")
+    def test_reflect_tables(self, mock_metadata):
+        # Test that tables are only reflected when not cached yet
+        table = Table("products", MetaData(), Column("productid", String))
+        mock_metadata.tables = {"public.products": table}
+        engine = MagicMock(spec=Engine)
+        self.assertEqual(
+            reflect_tables(engine, "public", ["products"]), {"products": table}
+        )
+        mock_metadata.reflect.assert_not_called()
+
+        mock_metadata.reflect.side_effect = lambda **kwargs: mock_metadata.tables.update(
+            {"public.orders": table}
+        )
+        reflect_tables(engine, "public", ["products", "orders"])
+        mock_metadata.reflect.assert_called_once_with(
+            bind=engine, schema="public", only=["orders"]
+        )
+
+    def test_get_primary_keys(self):
+        # Test that primary keys are looked up for tables that have one
+        metadata = MetaData()
+        tables = {
+            "products": Table(
+                "products", metadata, Column("productid", String, primary_key=True)
+            ),
+            "raw_products": Table("raw_products", metadata, Column("payload", JSON)),
+        }
+        self.assertEqual(get_primary_keys(tables), {"products": "productid"})
+
+    def test_get_table_dependencies(self):
+        # Test that tables depend on the tables their foreign keys reference
+        metadata = MetaData()
+        tables = {
+            "products": Table(
+                "products", metadata, Column("productid", String, primary_key=True)
+            ),
+            "orders": Table(
+                "orders",
+                metadata,
+                Column("orderid", String, primary_key=True),
+                Column("productid", String, ForeignKey("products.productid")),
+            ),
+        }
+        self.assertEqual(
+            get_table_dependencies(tables, ["products", "orders"]),
+            {"products": [], "orders": ["products"]},
+        )
+
+    def test_sort_tables(self):
+        # Test that referenced tables come first and cycles are rejected
+        self.assertEqual(
+            sort_tables({"orders": ["products"], "products": []}),
+            ["products", "orders"],
+        )
+        with self.assertRaises(ValueError):
+            sort_tables({"orders": ["products"], "products": ["orders"]})
+
+    @patch("main.upsert_rows")
+    @patch("main.save_to_raw_data_table")
+    @patch("main.read_csv")
+    def test_process_table_waits_for_dependencies(
+        self, mock_read_csv, mock_save_raw, mock_upsert_rows
+    ):
+        # Test that rows are only upserted once referenced tables are saved
+        schema = get_table_schemas()["products"]
+        df = pd.DataFrame(
+            {
+                "productid": ["abc123"],
+                "name": ["Product 1"],
+                "quantity": [10],
+                "category": ["Category A"],
+                "subcategory": ["Subcategory 1"],
+            }
+        )
+        mock_read_csv.return_value = iter([df])
+        calls = []
+        dependency = MagicMock()
+        dependency.result.side_effect = lambda: calls.append("dependency")
+        mock_upsert_rows.side_effect = lambda *args: calls.append("upsert")
+        tables = {"raw_products": MagicMock(), "products": MagicMock()}
+        error_handler = errorHandler()
+        process_table(
+            "products",
+            schema,
+            MagicMock(spec=Engine),
+            tables,
+            {"products": "productid"},
+            error_handler,
+            [dependency],
+        )
+        self.assertEqual(calls, ["dependency", "upsert"])
+        mock_save_raw.assert_called_once()
+        self.assertFalse(error_handler.errors)
 
     def test_validate_schema(self):
         # Test schema validation
@@ -109,100 +344,296 @@ class TestMain(unittest.TestCase):
             }
         )
         error_handler = errorHandler()
-        validate_schema(df_valid, schema, error_handler)
+        self.assertEqual(len(validate_schema(df_valid, schema, error_handler)), 2)
         self.assertFalse(error_handler.errors)
-        validate_schema(df_invalid, schema, error_handler)
+        self.assertTrue(validate_schema(df_invalid, schema, error_handler).empty)
         self.assertTrue(error_handler.errors)
 
+    def test_validate_schema_drops_invalid_rows(self):
+        # Test that only rows with invalid fields are dropped
+        schema = get_table_schemas()["products"]
+        df = pd.DataFrame(
+            {
+                "productid": ["abc123", "abc123", "def456"],
+                "name": ["Product 1", "Product 1", None],
+                "quantity": [10, 11, 20],
+                "category": ["Category A", "Category A", "Category B"],
+                "subcategory": ["Subcategory 1", "Subcategory 1", "Subcategory 2"],
+            }
+        )
+        error_handler = errorHandler()
+        valid_df = validate_schema(df, schema, error_handler)
+        # Duplicate keys are kept for the upsert to resolve
+        self.assertEqual(list(valid_df["productid"]), ["abc123", "abc123"])
+        self.assertEqual(len(error_handler.errors), 2)
+        self.assertIn("row def456", error_handler.errors[-1].errors)
+
     def test_save_to_raw_data_table(self):
         # Test saving data to raw data table
         metadata = MetaData()
         table = Table(
             "raw_products",
             metadata,
-            Column("productid", String),
+            Column("payload", JSON),
+            Column("timestamp", String),
+        )
+        df = pd.DataFrame(
+            {
+                "productid": ["abc1236"],
+                "name": ["Product 1"],
+                "quantity": [10],
+                "category": ["Category A"],
+                "subcategory": [None],
+            }
+        )
+        conn = MagicMock(spec=Connection)
+        conn.dialect = postgresql.dialect()
+        cursor = conn.connection.cursor.return_value
+        error_handler = errorHandler()
+        save_to_raw_data_table(df, table, conn, error_handler)
+        self.assertFalse(error_handler.errors)
+        copy = cursor.copy.return_value.__enter__.return_value
+        self.assertIn("(payload, timestamp) FROM STDIN", cursor.copy.call_args.args[0])
+        copy.write_row.assert_called_once()
+        payload = copy.write_row.call_args.args[0][0]
+        self.assertEqual(json.loads(payload)["productid"], "abc1236")
+        self.assertIsNone(json.loads(payload)["subcategory"])
+
+    def test_save_to_raw_data_table_timestamp(self):
+        # Test that every row of a batch shares the same timestamp
+        table = Table(
+            "raw_products",
+            MetaData(),
+            Column("payload", JSON),
+            Column("timestamp", String),
+        )
+        df = pd.DataFrame({"productid": ["abc123", "def456"]})
+        conn = MagicMock(spec=Connection)
+        conn.dialect = postgresql.dialect()
+        cursor = conn.connection.cursor.return_value
+        save_to_raw_data_table(df, table, conn, errorHandler())
+        copy = cursor.copy.return_value.__enter__.return_value
+        timestamps = {call.args[0][1] for call in copy.write_row.call_args_list}
+        self.assertEqual(copy.write_row.call_count, 2)
+        self.assertEqual(len(timestamps), 1)
+
+    def mock_staging_conn(self, table, columns, invalid_rows=()):
+        # Mock a connection that merges the staged rows, failing on invalid rows
+        conn = MagicMock(spec=Connection)
+        conn.dialect = postgresql.dialect()
+        _, _, upsert_stmt, _, _ = build_upsert_statements(
+            table, columns[0], tuple(columns), conn.dialect
+        )
+        staged, merged = [], []
+        copy = conn.connection.cursor.return_value.copy.return_value
+        copy.__enter__.return_value.write_row.side_effect = staged.append
+
+        def execute(statement):
+            if statement is not upsert_stmt:
+                return MagicMock()
+            batch = list(staged)
+            staged.clear()
+            if any(row in invalid_rows for row in batch):
+                raise IntegrityError("INSERT", {}, Exception("violates constraint"))
+            merged.extend(batch)
+            return MagicMock(rowcount=len(batch))
+
+        conn.execute.side_effect = execute
+        return conn, merged
+
+    def test_upsert_rows(self):
+        # Test upserting rows into table
+        metadata = MetaData()
+        table = Table(
+            "products",
+            metadata,
+            Column("productid", String, primary_key=True),
             Column("name", String),
             Column("quantity", Integer),
             Column("category", String),
             Column("subcategory", String),
         )
-        row = (
+        df = pd.DataFrame(
             {
-                "productid": "abc1236",
-                "name": "Product 1",
-                "quantity": 10,
-                "category": "Category A",
-                "subcategory": "Subcategory 1",
+                "productid": ["abc123", "abc123"],
+                "name": ["Product 1", "Product 1 renamed"],
+                "quantity": [10, 11],
+                "category": ["Category A", "Category A"],
+                "subcategory": ["Subcategory 1", "Subcategory 1"],
             }
         )
+        conn = MagicMock(spec=Connection)
+        conn.dialect = postgresql.dialect()
+        cursor = conn.connection.cursor.return_value
         error_handler = errorHandler()
-        save_to_raw_data_table(row, table, MagicMock(spec=Engine), error_handler)
-        # Add assertions here
+        upsert_rows(df, table, "productid", conn, error_handler)
+        self.assertFalse(error_handler.errors)
+        create_stmt, _, upsert_stmt, truncate_stmt, drop_stmt = (
+            build_upsert_statements(
+                table, "productid", tuple(df.columns), conn.dialect
+            )
+        )
+        # The staging table is dropped before the next chunk creates it again
+        self.assertEqual(
+            [call.args[0] for call in conn.execute.call_args_list],
+            [create_stmt, upsert_stmt, truncate_stmt, drop_stmt],
+        )
+        copy = cursor.copy.return_value.__enter__.return_value
+        self.assertIn("COPY tmp_products", cursor.copy.call_args.args[0])
+        # Only the last row for a duplicated primary key is staged
+        copy.write_row.assert_called_once_with(
+            ("abc123", "Product 1 renamed", 11, "Category A", "Subcategory 1")
+        )
 
-    def test_validate_row_data(self):
-        # Test row data validation
-        schema = get_table_schemas()["products"]
+    def test_upsert_rows_nullable_values(self):
+        # Test that missing values of nullable dtypes are staged as None
         table = Table(
             "products",
             MetaData(),
-            Column("productid", String),
-            Column("name", String),
+            Column("productid", String, primary_key=True),
             Column("quantity", Integer),
-            Column("category", String),
-            Column("subcategory", String),
         )
-        # Create a DataFrame with a single row
-        data = {
-            "productid": ["abc123"],
-            "name": ["Product 1"],
-            "quantity": [10],
-            "category": ["Category A"],
-            "subcategory": ["Subcategory 1"],
-        }
-        df = pd.DataFrame(data)
-        # Convert the DataFrame to a DataFrame.itertuples object
-        rows = df.itertuples(index=False)
-        # Validate the row data
-        error_handler = errorHandler()
-        for row in rows:
-            self.assertTrue(validate_row_data(row, table, schema, error_handler))
+        df = pd.DataFrame(
+            {
+                "productid": ["abc123", "def456"],
+                "quantity": pd.array([10, None], dtype="Int64"),
+            }
+        )
+        conn = MagicMock(spec=Connection)
+        conn.dialect = postgresql.dialect()
+        cursor = conn.connection.cursor.return_value
+        upsert_rows(df, table, "productid", conn, errorHandler())
+        copy = cursor.copy.return_value.__enter__.return_value
+        rows = [call.args[0] for call in copy.write_row.call_args_list]
+        self.assertEqual(rows, [("abc123", 10), ("def456", None)])
+        self.assertIs(type(rows[0][1]), int)
 
-    def test_upsert_row(self):
-        # Test upserting row into table
-        engine = MagicMock(spec=Engine)
-        metadata = MetaData()
+    def test_build_upsert_statements(self):
+        # Test that the upsert statements are built once per table and columns
         table = Table(
             "products",
-            metadata,
+            MetaData(),
             Column("productid", String, primary_key=True),
             Column("name", String),
-            Column("quantity", Integer),
-            Column("category", String),
-            Column("subcategory", String),
         )
-        # Create a DataFrame with a single row
-        data = {
-            "productid": ["abc123"],
-            "name": ["Product 1"],
-            "quantity": [10],
-            "category": ["Category A"],
-            "subcategory": ["Subcategory 1"],
-        }
-        df = pd.DataFrame(data)
-        # Convert the DataFrame to a DataFrame.itertuples object
-        rows = df.itertuples(index=False)
-        # Upsert the row into the table
+        dialect = postgresql.dialect()
+        columns = ("productid", "name")
+        statements = build_upsert_statements(table, "productid", columns, dialect)
+        self.assertIs(
+            build_upsert_statements(table, "productid", columns, dialect), statements
+        )
+        create_stmt, copy_sql, upsert_stmt, truncate_stmt, drop_stmt = statements
+        self.assertIn("CREATE TEMP TABLE tmp_products", str(create_stmt))
+        self.assertEqual(copy_sql, "COPY tmp_products (productid, name) FROM STDIN")
+        self.assertIn(
+            "ON CONFLICT (productid) DO UPDATE",
+            str(upsert_stmt.compile(dialect=dialect)),
+        )
+        self.assertEqual(str(truncate_stmt), "TRUNCATE tmp_products")
+        self.assertEqual(str(drop_stmt), "DROP TABLE tmp_products")
+
+    def test_upsert_rows_error(self):
+        # Test that an error not caused by the rows is reported once and raised
+        table = Table(
+            "products",
+            MetaData(),
+            Column("productid", String, primary_key=True),
+            Column("name", String),
+        )
+        df = pd.DataFrame(
+            {"productid": ["abc123", "def456"], "name": ["Product 1", "Product 2"]}
+        )
+        conn = MagicMock(spec=Connection)
+        conn.dialect = postgresql.dialect()
+        conn.connection.cursor.return_value.copy.side_effect = OperationalError(
+            "COPY", {}, Exception("connection lost")
+        )
         error_handler = errorHandler()
-        for row in rows:
-            try:
-                upsert_row(row, table, engine, error_handler)
-            except KeyError as e:
-                error_handler.add_error(uuid4(), table.name, f"Error inserting row {row.productid}: {e}.")
-        # Assert the result
-        with engine.connect() as conn:
-            result = conn.execute(table.select()).fetchall()
-            #self.assertEqual(len(result), 1)
+        with self.assertRaises(OperationalError):
+            upsert_rows(df, table, "productid", conn, error_handler)
+        self.assertEqual(conn.connection.cursor.return_value.copy.call_count, 1)
+        self.assertEqual(len(error_handler.errors), 1)
+
+    def test_upsert_rows_invalid_row(self):
+        # Test that a row violating a constraint does not discard the other rows
+        table = Table(
+            "orders",
+            MetaData(),
+            Column("orderid", String, primary_key=True),
+            Column("productid", String),
+        )
+        df = pd.DataFrame(
+            {
+                "orderid": [f"order{i}" for i in range(5)],
+                "productid": ["prod1", "prod1", "missing", "prod1", "prod1"],
+            }
+        )
+        conn, merged = self.mock_staging_conn(
+            table, ["orderid", "productid"], [("order2", "missing")]
+        )
+        error_handler = errorHandler()
+        upsert_rows(df, table, "orderid", conn, error_handler)
+        self.assertEqual(
+            sorted(row[0] for row in merged), ["order0", "order1", "order3", "order4"]
+        )
+        self.assertEqual(len(error_handler.errors), 1)
+        self.assertIn("row order2", error_handler.errors[0].errors)
 
+    @patch("main.UPSERT_MIN_SPLIT_ROWS", 4)
+    @patch("main.UPSERT_MIN_FAILED_BATCHES", 4)
+    def test_upsert_rows_all_invalid(self):
+        # Test that splitting stops once every small batch has failed
+        table = Table(
+            "orders",
+            MetaData(),
+            Column("orderid", String, primary_key=True),
+            Column("productid", String),
+        )
+        df = pd.DataFrame(
+            {
+                "orderid": [f"order{i}" for i in range(16)],
+                "productid": ["missing"] * 16,
+            }
+        )
+        rows = list(df.itertuples(index=False, name=None))
+        conn, merged = self.mock_staging_conn(table, ["orderid", "productid"], rows)
+        error_handler = errorHandler()
+        upsert_rows(df, table, "orderid", conn, error_handler)
+        self.assertFalse(merged)
+        # One merge of 16 rows, two of 8 and four of 4, instead of 31
+        self.assertEqual(conn.connection.cursor.return_value.copy.call_count, 7)
+        self.assertEqual(len(error_handler.errors), 1)
+        self.assertIn("order15", error_handler.errors[0].errors)
+
+    def test_save_errors(self):
+        # Test that errors are saved in one batch without managing the transaction
+        error_handler = errorHandler()
+        error_handler.errors_table = Table(
+            "errors",
+            MetaData(),
+            Column("recordid", String, primary_key=True),
+            Column("recordtype", String),
+            Column("errors", JSON),
+            Column("timestamp", String),
+        )
+        error_handler.add_error(uuid4(), "products", "error 1")
+        error_handler.add_error(uuid4(), "products", "error 2")
+        conn = MagicMock(spec=Connection)
+        error_handler.save_errors(conn)
+        conn.execute.assert_called_once()
+        self.assertEqual(len(conn.execute.call_args.args[1]), 2)
+        conn.commit.assert_not_called()
+        conn.close.assert_not_called()
+
+
+    def test_error_timestamp(self):
+        # Test that each error gets the time it was added
+        before = datetime.now()
+        error_handler = errorHandler()
+        error_handler.add_error(uuid4(), "products", "error 1")
+        timestamp = error_handler.errors[0].timestamp
+        self.assertIsInstance(timestamp, datetime)
+        self.assertGreaterEqual(timestamp, before)
 
 if __name__ == "__main__":
     unittest.main()